@@ -13,19 +13,35 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import functools
+import grp
 import logging
 import os
 import os.path
+import pwd
+import random
 import shutil
+import signal
+import stat
 import subprocess
 import sys
 from textwrap import dedent
 import time
+from typing import List, Tuple
 
 import kubernetes
-import psycopg2
-from tenacity import before_log, retry, retry_if_exception_type, stop_after_delay, wait_random_exponential
+from tenacity import (
+    before_log,
+    retry,
+    retry_if_exception,
+    retry_if_exception_type,
+    stop_after_delay,
+    wait_random_exponential,
+)
+import urllib3.exceptions
+from urllib3.util import Retry
 
 
 PGDATA = os.environ["PGDATA"]  # No underscore, PostgreSQL config
@@ -36,6 +52,8 @@ PG_HBA_CONF = os.path.join(PG_CONF_DIR, "pg_hba.conf")
 PG_BIN = os.path.join("/usr/lib/postgresql", PG_MAJOR, "bin")
 PG_STANDBY_SIGNAL = os.path.join(PGDATA, "standby.signal")  # Formerly recovery.conf
 
+PG_LOG = f"/var/log/postgresql/postgresql-{PG_MAJOR}-main.log"
+
 REPMGR_CONF = "/srv/pgconf/repmgr.conf"
 REPMGR_LOG = "/var/log/postgresql/repmgr.log"
 
@@ -46,14 +64,134 @@ JUJU_APPLICATION = os.environ["JUJU_APPLICATION"]
 JUJU_UNIT_NAME = f"{JUJU_APPLICATION}/{JUJU_POD_NUMBER}"
 JUJU_EXPECTED_UNITS = os.environ["JUJU_EXPECTED_UNITS"].split(" ")
 
+# Tunables set from charm config, which validates them. Defaults match
+# config.yaml and PostgreSQL's own.
+PG_MAX_WAL_SIZE = os.environ.get("PG_MAX_WAL_SIZE", "1GB")
+PG_CHECKPOINT_TIMEOUT = os.environ.get("PG_CHECKPOINT_TIMEOUT", "5min")
+PG_WAL_COMPRESSION = os.environ.get("PG_WAL_COMPRESSION", "off")
+
 NAMESPACE = os.environ["JUJU_POD_NAMESPACE"]
 HOSTNAME = os.environ["HOSTNAME"]
 
-AS_PG_CMD = ["sudo", "-u", "postgres", "-EH", "--"]
+# Run commands as the postgres user. setpriv execs the command
+# directly, where sudo would fork and wait. The repmgrd callbacks
+# already run as postgres, so need no prefix.
+AS_PG_CMD = ["setpriv", "--reuid=postgres", "--regid=postgres", "--init-groups", "--"] if os.geteuid() == 0 else []
+PG_ENV = dict(os.environ, HOME=os.path.expanduser("~postgres"), USER="postgres", LOGNAME="postgres")
 REPMGR_CMD = AS_PG_CMD + ["repmgr", "-f", REPMGR_CONF]
+REPMGRD_CMD = AS_PG_CMD + ["repmgrd", "-v", "-f", REPMGR_CONF, "--daemonize=false", "--no-pid-file"]
+
+# initdb options are set in createcluster.conf. Only extras need to be
+# passed.
+INITDB_CMD = ["pg_createcluster", PG_MAJOR, "main", "--locale=en_US.UTF-8", "--port=5432", "--datadir=" + PGDATA]
+# -D is the config directory, which points at the data directory.
+PG_START_CMD = AS_PG_CMD + [os.path.join(PG_BIN, "pg_ctl"), "-D", PG_CONF_DIR, "-l", PG_LOG, "-w", "start"]
+PG_SINGLE_USER_CMD = AS_PG_CMD + [os.path.join(PG_BIN, "postgres"), "--single", "-D", PG_CONF_DIR]
+
+MASTER_SELECTOR = f"juju-app={JUJU_APPLICATION},role=master"
+
+# Configuration depends only on the environment, so render it once.
+PG_CONF_OVERRIDE = dedent(
+    f"""\
+    # This file is maintained by the Juju PostgreSQL k8s charm
+    listen_addresses = '*'
+    hot_standby = on
+    wal_level = replica
+    max_wal_senders = {len(JUJU_EXPECTED_UNITS) + 2 + 2}  # num units + 2 (repmgr) + slack
+    wal_log_hints = on  # Ignored due to data checksums, but just in case
+    wal_keep_segments = 500  # TODO: WAL archiving needed for real deployments
+    archive_mode = on
+    archive_command = '/bin/true'
+
+    max_wal_size = '{PG_MAX_WAL_SIZE}'
+    checkpoint_timeout = '{PG_CHECKPOINT_TIMEOUT}'
+    wal_compression = {PG_WAL_COMPRESSION}
+
+    shared_preload_libraries = 'repmgr'  # Required for using repmgrd
+    """
+)
+
+PG_HBA_MARKER = "# These rules are appended by Juju"
+PG_HBA_RULES = dedent(
+    f"""\
+    {PG_HBA_MARKER}
+    # TODO: Can we restrict them to just the pod IPs?
+    host all         all 0.0.0.0/0 scram-sha-256
+    host all         all ::0/0     scram-sha-256
+    host replication all 0.0.0.0/0 scram-sha-256
+    host replication all ::0/0     scram-sha-256
+    """
+)
+
+PGPASS_TMPL = dedent(
+    """\
+    # This file is maintained by the Juju PostgreSQL k8s charm
+    *:*:repmgr:repmgr:{pw}
+    *:*:replication:repmgr:{pw}
+    """
+)
+
+
+def get_pod_hostname(name) -> str:
+    return f"{JUJU_APPLICATION}-{name}"
+
+
+REPMGR_CONF_CONTENT = dedent(
+    f"""\
+    # This file maintained by the Juju PostgreSQL k8s charm
+
+    node_id={JUJU_POD_NUMBER + 1}
+    node_name='{JUJU_POD_NAME}'
+    data_directory='{PGDATA}'
+
+    pg_bindir='{PG_BIN}'
+    repmgr_bindir='{PG_BIN}'
+
+    log_level='INFO'
+    log_facility='STDERR'
+    log_file='{REPMGR_LOG}'  # TODO: Rotate this
+    log_status_interval=300
+
+    # Secret pulled from ~/.pgpass
+    conninfo='host={get_pod_hostname(JUJU_POD_NAME)} user=repmgr dbname=repmgr connect_timeout=2'
+
+    service_start_command   = 'pg_ctlcluster {PG_MAJOR} main start'
+    service_stop_command    = 'pg_ctlcluster {PG_MAJOR} main stop'
+    service_restart_command = 'pg_ctlcluster {PG_MAJOR} main restart'
+    service_reload_command  = 'pg_ctlcluster {PG_MAJOR} main reload'
+    service_promote_command = 'pg_ctlcluster {PG_MAJOR} main promote'
+
+    # We do not set a location. We would need 2 nodes (or
+    # one node + one witness) in each location or failover
+    # will not occur.
+    # location='{JUJU_NODE_NAME}'
+
+    primary_visibility_consensus=true
+    standby_disconnect_on_failover=true
+    standby_reconnect_timeout=180
+    node_rejoin_timeout=180
+
+    failover=automatic
+    promote_command='/usr/local/bin/repmgr_promote_command.py'
+    follow_command='/usr/local/bin/repmgr_follow_command.py %n'
+
+    # TODO: Schedule 'repmgr cluster cleanup'
+    monitoring_history=yes
+    """
+)
 
 log = logging.getLogger(__name__)
 
+# Shared k8s API client, initialized by configure_k8s_api()
+_k8s_api = None
+
+# Names of pods labeled as master, when they were fetched, and the
+# resourceVersion of that list.
+_masters_cache = None
+
+# Connection to the local PostgreSQL as superuser, opened by pg_admin()
+_pg_con = None
+
 
 class NoMasterException(Exception):
     """Exception raised by get_master when there is no master
@@ -64,51 +202,139 @@ class NoMasterException(Exception):
     pass
 
 
+def _before_attempt(retry_state):
+    # A failed attempt may have been caused by a change of master, so
+    # don't retry with a cached master list.
+    if retry_state.attempt_number > 1:
+        invalidate_masters()
+    _log_attempt(retry_state)
+
+
+_log_attempt = before_log(log, logging.DEBUG)
+
+
+def _is_pg_operational_error(e: BaseException) -> bool:
+    # psycopg2 is imported on first use, and its exceptions cannot be
+    # raised before then.
+    psycopg2 = sys.modules.get("psycopg2")
+    return psycopg2 is not None and isinstance(e, psycopg2.OperationalError)
+
+
 # tenacity.retry decorator, retrying on PostgreSQL exceptions.
 # Such as connection failures caused when attempting to connect
 # to a database that isn't ready yet, and retrying on
 # CalledProcessError, as returned by failed repmgr commands,
 # and retrying on NoMasterException, when we need the master
-# but it isn't available yet.
+# but it isn't available yet, and on k8s API failures that outlasted
+# the client's own Retry policy (see configure_k8s_api).
 pgretry = functools.partial(
     retry,
-    retry=retry_if_exception_type(psycopg2.OperationalError)
+    retry=retry_if_exception(_is_pg_operational_error)
     | retry_if_exception_type(subprocess.CalledProcessError)
-    | retry_if_exception_type(NoMasterException),
+    | retry_if_exception_type(NoMasterException)
+    | retry_if_exception_type(urllib3.exceptions.HTTPError),
     stop=stop_after_delay(300),
     wait=wait_random_exponential(multiplier=1, max=20),
     reraise=True,
-    before=before_log(log, logging.DEBUG),
+    before=_before_attempt,
 )
 
 
+def run(cmd: List[str], env=None):
+    log.info(f"Running {' '.join(cmd)}")
+    # Python and libpq open their descriptors close-on-exec, so there
+    # is nothing to leak. Skipping the descriptor sweep lets
+    # subprocess use posix_spawn.
+    subprocess.run(cmd, check=True, text=True, close_fds=False, env=env)
+
+
+def write_file(path: str, content: str, mode: int = 0o644, user: str = None, group: str = None) -> bool:
+    """Atomically replace path with content, unless it is unchanged.
+
+    The new file is created with mode, and owned by user and group if
+    given, before it is moved into place. If the content is unchanged,
+    the mode and ownership of the existing file are corrected instead.
+    Returns True if the file was written.
+    """
+    data = content.encode()
+    ids = get_ids(user, group) if user is not None else None
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                log.debug(f"{path} is unchanged")
+                st = os.fstat(f.fileno())
+                if ids is not None and (st.st_uid, st.st_gid) != ids:
+                    log.info(f"Updating ownership of {path}")
+                    os.fchown(f.fileno(), *ids)
+                if stat.S_IMODE(st.st_mode) != mode:
+                    log.info(f"Updating permissions of {path}")
+                    os.fchmod(f.fileno(), mode)
+                return False
+    except FileNotFoundError:
+        pass
+    tmp = f"{path}.tmp.{os.getpid()}"
+    try:
+        os.unlink(tmp)  # Left over from a crash, maybe by an earlier pod with our pid.
+    except FileNotFoundError:
+        pass
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    try:
+        os.fchmod(fd, mode)  # Not masked by the umask, unlike os.open()
+        if ids is not None:
+            os.fchown(fd, *ids)
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+    return True
+
+
+@functools.lru_cache()
+def get_ids(user: str, group: str) -> Tuple[int, int]:
+    """Return the uid of user and gid of group, looked up once."""
+    return pwd.getpwnam(user).pw_uid, grp.getgrnam(group).gr_gid
+
+
+def set_perms(path: str, user: str, group: str, mode: int = None):
+    """Set ownership, and optionally mode, of path if not already correct."""
+    st = os.stat(path)
+    uid, gid = get_ids(user, group)
+    if (st.st_uid, st.st_gid) != (uid, gid):
+        log.info(f"Updating ownership of {path}")
+        os.chown(path, uid, gid)
+    if mode is not None and stat.S_IMODE(st.st_mode) != mode:
+        log.info(f"Updating permissions of {path}")
+        os.chmod(path, mode)
+
+
 def fix_mounts():
-    log.info("Updating permissions and ownership of /srv")
     # Fix permissions on mounts and initialize with required dirs.
-    shutil.chown("/srv", user="root", group="postgres")
-    os.chmod("/srv", 0o775)
-
-    log.info("Updating permissions and ownership of /var/log/postgresql")
-    shutil.chown("/var/log/postgresql", user="root", group="postgres")
-    os.chmod("/var/log/postgresql", 0o1775)
+    set_perms("/srv", "root", "postgres", 0o775)
+    set_perms("/var/log/postgresql", "root", "postgres", 0o1775)
 
     for pgpath in ["/srv/pgdata", f"/srv/pgdata/{PG_MAJOR}", "/srv/pgconf"]:
-        log.info(f"Updating permissions and ownership of {pgpath}")
-        if not os.path.exists(pgpath):
-            os.mkdir(pgpath, mode=0o775)
-        shutil.chown(pgpath, user="postgres", group="postgres")
+        os.makedirs(pgpath, mode=0o775, exist_ok=True)
+        set_perms(pgpath, "postgres", "postgres")
+
+
+def fix_mounts_and_repmgr_conf():
+    fix_mounts()
+    update_repmgr_conf()
 
 
 def db_exists() -> bool:
     return os.path.isdir(PGDATA)
 
 
-def maybe_create_db() -> bool:
+def maybe_create_db(standby: bool = False) -> bool:
     if db_exists():
         log.info(f"PostgreSQL database cluster exists at {PGDATA}")
         return False
 
-    initdb()  # This also creates config files.
+    # This also creates config files. A new standby's database is
+    # replaced by a clone of the master, so don't bother syncing it
+    # to disk.
+    initdb(sync=not standby)
 
     return True
 
@@ -118,186 +344,118 @@ def clone_master():
     # Determine the master inside this function rather than pass it,
     # so that if the retry decorator needs to retry it we catch any
     # changes.
-    master = get_master()
+    master = wait_master()
     master_hostname = get_pod_hostname(master)
     log.info(f"Cloning database from {master} ({master_hostname})")
     shutil.rmtree(PGDATA)
     cmd = REPMGR_CMD + ["-h", master_hostname, "-U", "repmgr", "-d", "repmgr", "standby", "clone", "-c"]
-    log.info(f"Running {' '.join(cmd)}")
-    subprocess.run(cmd, check=True, text=True)
+    run(cmd, env=PG_ENV)
 
 
 def show_repmgr_cluster():
     cmd = REPMGR_CMD + ["cluster", "show"]
-    log.info(f"Running {' '.join(cmd)}")
-    subprocess.run(cmd, check=True, text=True)
+    run(cmd, env=PG_ENV)
 
 
-def initdb():
+def initdb(sync: bool = True):
     log.warning(f"Creating new database cluster in {PGDATA}")
-    os.makedirs(PGDATA, mode=0o755)  # mode for intermediate directories
-    shutil.chown(PGDATA, user="postgres", group="postgres")
+    os.makedirs(PGDATA, mode=0o755, exist_ok=True)  # mode for intermediate directories
+    os.chown(PGDATA, *get_ids("postgres", "postgres"))
     os.chmod(PGDATA, 0o700)  # Required mode for $PGDATA
-    cmd = [
-        "pg_createcluster",
-        PG_MAJOR,
-        "main",
-        "--locale=en_US.UTF-8",
-        "--port=5432",
-        "--datadir=" + PGDATA,
-        "--",
-        "--auth-local=trust",
-        "--auth-host=scram-sha-256",
-    ]
-    log.info(f"Running {' '.join(cmd)}")
-    subprocess.run(cmd, check=True, text=True)
+    cmd = INITDB_CMD + ([] if sync else ["--", "--no-sync"])
+    run(cmd)
 
 
 def start_db():
     log.info("Starting PostgreSQL cluster")
-    subprocess.run(["pg_ctlcluster", PG_MAJOR, "main", "start"], check=True, text=True)
+    # Run pg_ctl directly, rather than via the pg_ctlcluster Perl
+    # wrapper. pg_ctlcluster would create the stats temp directory
+    # (as set in the Debian postgresql.conf), so do that here.
+    stats_temp_dir = f"/var/run/postgresql/{PG_MAJOR}-main.pg_stat_tmp"
+    os.makedirs(stats_temp_dir, mode=0o700, exist_ok=True)
+    os.chown(stats_temp_dir, *get_ids("postgres", "postgres"))
+    run(PG_START_CMD, env=PG_ENV)
 
 
 def update_postgresql_conf():
     pgconf_override = os.path.join(PG_CONF_DIR, "conf.d", "juju_charm.conf")
     log.info(f"Updating PostgreSQL configuration in {pgconf_override}")
-    with open(pgconf_override, "w") as outf:
-        outf.write(
-            dedent(
-                f"""\
-                # This file is maintained by the Juju PostgreSQL k8s charm
-                listen_addresses = '*'
-                hot_standby = on
-                wal_level = replica
-                max_wal_senders = {len(JUJU_EXPECTED_UNITS) + 2 + 2}  # num units + 2 (repmgr) + slack
-                wal_log_hints = on  # Ignored due to data checksums, but just in case
-                wal_keep_segments = 500  # TODO: WAL archiving needed for real deployments
-                archive_mode = on
-                archive_command = '/bin/true'
-
-                shared_preload_libraries = 'repmgr'  # Required for using repmgrd
-                """
-            )
-        )
-    os.chmod(pgconf_override, 0o644)
+    write_file(pgconf_override, PG_CONF_OVERRIDE)
 
-    hba = open(PG_HBA_CONF, "r").readlines()
-    marker = "# These rules are appended by Juju"
-    if (marker + "\n") not in hba:
+    with open(PG_HBA_CONF, "r") as f:
+        hba = f.read()
+    if PG_HBA_MARKER not in hba:
         with open(PG_HBA_CONF, "a") as outf:
             outf.write("\n")
-            outf.write(
-                dedent(
-                    f"""\
-                    {marker}
-                    # TODO: Can we restrict them to just the pod IPs?
-                    host all         all 0.0.0.0/0 scram-sha-256
-                    host all         all ::0/0     scram-sha-256
-                    host replication all 0.0.0.0/0 scram-sha-256
-                    host replication all ::0/0     scram-sha-256
-                    """
-                )
-            )
+            outf.write(PG_HBA_RULES)
 
 
+@functools.lru_cache(maxsize=1)
 def get_pgsql_admin_password():
-    return open("/charm-secrets/pgsql-admin-password", "r").read().strip()
+    with open("/charm-secrets/pgsql-admin-password", "r") as f:
+        return f.read().strip()
 
 
 def update_pgpass():
     root = os.path.expanduser("~root/.pgpass")
     pg = os.path.expanduser("~postgres/.pgpass")
     pw = get_pgsql_admin_password()
-    for pgpass in [root, pg]:
-        log.info(f"Overwriting {pgpass}, updating secrets")
-        with open(pgpass, "w") as outf:
-            outf.write(
-                dedent(
-                    f"""\
-                    # This file is maintained by the Juju PostgreSQL k8s charm
-                    *:*:repmgr:repmgr:{pw}
-                    *:*:replication:repmgr:{pw}
-                    """
-                )
-            )
-        os.chmod(pgpass, 0o600)
-    shutil.chown(pg, user="postgres", group="postgres")
+    content = PGPASS_TMPL.format_map(dict(pw=pw))
+    log.info(f"Updating {root}, {pg} secrets")
+    write_file(root, content, mode=0o600)
+    write_file(pg, content, mode=0o600, user="postgres", group="postgres")
 
 
 def update_repmgr_conf():
     log.info(f"Updating repmgr configuration in {REPMGR_CONF}")
-    hostname = get_pod_hostname(JUJU_POD_NAME)
-    with open(REPMGR_CONF, "w") as outf:
-        outf.write(
-            dedent(
-                f"""\
-                # This file maintained by the Juju PostgreSQL k8s charm
-
-                node_id={JUJU_POD_NUMBER + 1}
-                node_name='{JUJU_POD_NAME}'
-                data_directory='{PGDATA}'
-
-                pg_bindir='{PG_BIN}'
-                repmgr_bindir='{PG_BIN}'
-
-                log_level='INFO'
-                log_facility='STDERR'
-                log_file='{REPMGR_LOG}'  # TODO: Rotate this
-                log_status_interval=300
-
-                # Secret pulled from ~/.pgpass
-                conninfo='host={hostname} user=repmgr dbname=repmgr connect_timeout=2'
-
-                service_start_command   = 'pg_ctlcluster {PG_MAJOR} main start'
-                service_stop_command    = 'pg_ctlcluster {PG_MAJOR} main stop'
-                service_restart_command = 'pg_ctlcluster {PG_MAJOR} main restart'
-                service_reload_command  = 'pg_ctlcluster {PG_MAJOR} main reload'
-                service_promote_command = 'pg_ctlcluster {PG_MAJOR} main promote'
-
-                # We do not set a location. We would need 2 nodes (or
-                # one node + one witness) in each location or failover
-                # will not occur.
-                # location='{JUJU_NODE_NAME}'
-
-                primary_visibility_consensus=true
-                standby_disconnect_on_failover=true
-                standby_reconnect_timeout=180
-                node_rejoin_timeout=180
-
-                failover=automatic
-                promote_command='/usr/local/bin/repmgr_promote_command.py'
-                follow_command='/usr/local/bin/repmgr_follow_command.py %n'
-
-                # TODO: Schedule 'repmgr cluster cleanup'
-                monitoring_history=yes
-                """
-            )
-        )
-    os.chmod(REPMGR_CONF, 0o644)
+    write_file(REPMGR_CONF, REPMGR_CONF_CONTENT)
+
+
+@contextmanager
+def pg_admin():
+    """Yield an autocommit superuser connection to the local database.
+
+    The connection is opened on first use and reused after that. It is
+    discarded if it fails, so a retry reconnects.
+    """
+    import psycopg2  # Only needed on the master, so import on demand
+
+    global _pg_con
+    if _pg_con is None or _pg_con.closed:
+        _pg_con = psycopg2.connect("dbname=postgres user=postgres connect_timeout=2")
+        _pg_con.autocommit = True
+    try:
+        yield _pg_con
+    except psycopg2.OperationalError:
+        _pg_con.close()
+        _pg_con = None
+        raise
 
 
 # Retry in case local PostgreSQL is still starting up.
 @pgretry
 def update_repmgr_db():
     log.info(f"Resetting repmgr database user password")
-    con = psycopg2.connect("dbname=postgres user=postgres")
-    con.autocommit = True
-    cur = con.cursor()
     pw = get_pgsql_admin_password()
+    with pg_admin() as con, con.cursor() as cur:
+        cur.execute(
+            """
+            SELECT
+                EXISTS (SELECT FROM pg_roles WHERE rolname='repmgr'),
+                EXISTS (SELECT FROM pg_database WHERE datname='repmgr')
+            """
+        )
+        role_exists, repmgr_db_exists = cur.fetchone()
 
-    cur.execute("SELECT TRUE FROM pg_roles WHERE rolname='repmgr'")
-    exists = cur.fetchone() is not None
-
-    cmd = "ALTER" if exists else "CREATE"
-    cur.execute(f"{cmd} ROLE repmgr WITH LOGIN SUPERUSER REPLICATION PASSWORD %s", (pw,))
-
-    log.info(f"Maintaining repmgr database")
-    cur.execute("SELECT TRUE FROM pg_database WHERE datname='repmgr'")
-    exists = cur.fetchone() is not None
-    if exists:
-        cur.execute("ALTER DATABASE repmgr OWNER TO repmgr")
-    else:
-        cur.execute("CREATE DATABASE repmgr OWNER repmgr")
+        cmd = "ALTER" if role_exists else "CREATE"
+        sql = f"{cmd} ROLE repmgr WITH LOGIN SUPERUSER REPLICATION PASSWORD %s"
+        log.info(f"Maintaining repmgr database")
+        if repmgr_db_exists:
+            cur.execute(sql + "; ALTER DATABASE repmgr OWNER TO repmgr", (pw,))
+        else:
+            # CREATE DATABASE cannot be run in a multi-statement query
+            cur.execute(sql, (pw,))
+            cur.execute("CREATE DATABASE repmgr OWNER repmgr")
 
 
 # Retry in case DNS resolution is slow, waiting for the appname-master
@@ -307,14 +465,13 @@ def register_repmgr_master():
     log.info(f"Registering PostgreSQL primary server with repmgr")
     # Always reregister with force, as our IP address might have changed.
     cmd = REPMGR_CMD + ["primary", "register", "--force"]
-    log.info(f"Running {' '.join(cmd)}")
-    subprocess.run(cmd, check=True, text=True)
+    run(cmd, env=PG_ENV)
 
 
 # Retry in case the master is not running, or gets shut down midway.
 @pgretry
 def register_repmgr_standby():
-    master = get_master()
+    master = wait_master()
     log.info(f"Registering PostgreSQL hot standby server with {master}")
     # Always reregister with force, as our IP address might have changed.
     cmd = REPMGR_CMD + [
@@ -328,11 +485,8 @@ def register_repmgr_standby():
         "repmgr",
         "-d",
         "repmgr",
-        "--verbose",  # TODO: Turn off verbosity?
-        "--log-level=DEBUG",  # TODO: Turn off debug?
     ]
-    log.info(f"Running {' '.join(cmd)}")
-    subprocess.run(cmd, check=True, text=True)
+    run(cmd, env=PG_ENV)
 
 
 def reconnect_repmgr_standby():
@@ -355,19 +509,26 @@ def reconnect_repmgr_standby():
 # Retry in case the master is not running.
 @pgretry
 def follow_master():
-    master = get_master()
+    master = wait_master()
     log.info(f"Hot standby following {master}")
     master_hostname = get_pod_hostname(master)
     assert os.path.exists(PG_STANDBY_SIGNAL)
     start_db()
     cmd = REPMGR_CMD + ["-h", master_hostname, "-U", "repmgr", "-d", "repmgr", "standby", "follow"]
-    log.info(f"Running {' '.join(cmd)}")
-    subprocess.run(cmd, check=True, text=True)
+    run(cmd, env=PG_ENV)
+
+
+# Failure messages for the documented 'repmgr node rejoin' return codes.
+_REJOIN_ERRORS = {
+    1: "Bad repmgr configuration",  # Should not happen
+    4: "PostgreSQL could not be restarted by repmgr",  # TODO: DB corrupt? Maybe reclone?
+    24: "The repmgr rejoin operation failed",
+}
 
 
 @pgretry
 def rejoin_master():
-    master = get_master()
+    master = wait_master()
     log.info(f"Deposed master rejoining, following {master}")
     master_hostname = get_pod_hostname(master)
 
@@ -377,18 +538,12 @@ def rejoin_master():
 
     cmd = REPMGR_CMD + ["-h", master_hostname, "-U", "repmgr", "-d", "repmgr", "node", "rejoin", "--force-rewind"]
     log.info(f"Running {' '.join(cmd)}")
-    r = subprocess.run(cmd, text=True)
+    r = subprocess.run(cmd, text=True, close_fds=False, env=PG_ENV)
     # The 'rejoin' return codes documented, so use them.
     if r.returncode == 0:
         log.info(f"PostgreSQL hot standby rejoined {master}")
         return
-    elif r.returncode == 1:
-        raise RuntimeError("Bad repmgr configuration")  # Should not happen
-    elif r.returncode == 4:
-        raise RuntimeError("PostgreSQL could not be restarted by repmgr")  # TODO: DB corrupt? Maybe reclone?
-    elif r.returncode == 24:
-        raise RuntimeError("The repmgr rejoin operation failed")
-    raise RuntimeError("The repmgr rejoin operation failed with an unknown error")
+    raise RuntimeError(_REJOIN_ERRORS.get(r.returncode, "The repmgr rejoin operation failed with an unknown error"))
 
 
 def ensure_consistent_db():
@@ -399,13 +554,38 @@ def ensure_consistent_db():
     else:
         log.warning("PostgreSQL is not following. Deposed master?")
     # -D $PG_CONF_DIR because we are using Debian layout (not -D $PGDATA).
-    cmd = AS_PG_CMD + [os.path.join(PG_BIN, "postgres"), "--single", "-D", PG_CONF_DIR]
+    cmd = PG_SINGLE_USER_CMD
     log.info(f"Running {' '.join(cmd)}")
-    subprocess.run(cmd, check=True, text=True, stdin=subprocess.DEVNULL)
+    subprocess.run(cmd, check=True, text=True, stdin=subprocess.DEVNULL, close_fds=False, env=PG_ENV)
 
 
 def configure_k8s_api():
+    global _k8s_api
+    if _k8s_api is not None:
+        return  # Already loaded the service account token and CA
     kubernetes.config.load_incluster_config()
+    conf = kubernetes.client.Configuration.get_default_copy()
+    conf.connection_pool_maxsize = 4
+    # Retry transient API server failures with backoff. Once the retries
+    # are used up, urllib3 raises MaxRetryError (an HTTPError) rather
+    # than an ApiException. pgretry retries it again around the master
+    # lookups, and wait_master() falls back to polling on it. Elsewhere
+    # it fails the entrypoint, and k8s restarts the pod.
+    conf.retries = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "PATCH"]),
+    )
+    # A single ApiClient, so its urllib3 connection pool and TLS
+    # sessions get reused for all calls to the k8s API.
+    _k8s_api = kubernetes.client.CoreV1Api(kubernetes.client.ApiClient(conf))
+
+
+def k8s_api() -> kubernetes.client.CoreV1Api:
+    if _k8s_api is None:
+        configure_k8s_api()
+    return _k8s_api
 
 
 def is_master() -> bool:
@@ -415,11 +595,35 @@ def is_master() -> bool:
         return False
 
 
+def list_masters(ttl: float = 2.0, consistent: bool = False) -> List[str]:
+    """Return the names of the pods labeled as master.
+
+    Results up to ttl seconds old are reused, so the several lookups
+    made during master election cost a single API round trip. Fresh
+    lookups are served from the API server's watch cache, which may
+    lag slightly, unless consistent is set to require a quorum read.
+    """
+    global _masters_cache
+    now = time.monotonic()
+    if consistent or _masters_cache is None or now - _masters_cache[1] > ttl:
+        api = k8s_api()
+        kw = {} if consistent else {"resource_version": "0"}
+        pods = api.list_namespaced_pod(NAMESPACE, label_selector=MASTER_SELECTOR, **kw)
+        _masters_cache = ([i.metadata.name for i in pods.items], now, pods.metadata.resource_version)
+    return _masters_cache[0]
+
+
+def invalidate_masters():
+    """Forget the cached master list, after changing role labels."""
+    global _masters_cache
+    _masters_cache = None
+
+
 def get_master() -> str:
-    cl = kubernetes.client.ApiClient()
-    api = kubernetes.client.CoreV1Api(cl)
-    master_selector = f"juju-app={JUJU_APPLICATION},role=master"
-    masters = [i.metadata.name for i in api.list_namespaced_pod(NAMESPACE, label_selector=master_selector).items]
+    masters = list_masters()
+    if len(masters) == 0 and JUJU_UNIT_NAME == JUJU_EXPECTED_UNITS[0]:
+        # Don't promote ourselves based on a possibly stale list.
+        masters = list_masters(consistent=True)
     if len(masters) == 1:
         return masters[0]
     elif len(masters) == 0 and JUJU_UNIT_NAME == JUJU_EXPECTED_UNITS[0]:
@@ -435,83 +639,137 @@ def get_master() -> str:
     raise NoMasterException()
 
 
+def wait_master(timeout: int = 300) -> str:
+    """Return the master, waiting up to timeout seconds for one to be elected.
+
+    Rather than polling, watch for a pod to be labeled as master.
+    If the watch fails, fall back to polling with jittered exponential
+    backoff. Raises NoMasterException if there is still no master at
+    timeout.
+    """
+    try:
+        return get_master()
+    except NoMasterException:
+        log.info("Waiting for a master to be elected")
+    deadline = time.monotonic() + timeout
+    # Watch from the list we just checked, so no label change made
+    # since then is missed.
+    resource_version = _masters_cache[2] if _masters_cache else None
+    w = kubernetes.watch.Watch()
+    try:
+        for event in w.stream(
+            k8s_api().list_namespaced_pod,
+            NAMESPACE,
+            label_selector=MASTER_SELECTOR,
+            resource_version=resource_version,
+            timeout_seconds=timeout,
+            # Client side too, in case the connection is silently dropped.
+            _request_timeout=(10, timeout),
+        ):
+            if event["type"] in ("ADDED", "MODIFIED"):
+                w.stop()
+    except (kubernetes.client.rest.ApiException, urllib3.exceptions.HTTPError) as e:
+        # HTTPError includes MaxRetryError from the client's Retry
+        # policy, and ProtocolError or ReadTimeoutError mid stream.
+        log.warning(f"Unable to watch for master ({e}), polling instead")
+        delay = 0.1
+        while time.monotonic() < deadline:
+            invalidate_masters()
+            try:
+                return get_master()
+            except (NoMasterException, urllib3.exceptions.HTTPError):
+                pass
+            time.sleep(min(delay + random.random() * delay, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 2, 5.0)
+    # Confirm, rather than trust the event, in case multiple masters
+    # have been labeled or the watch timed out.
+    invalidate_masters()
+    return get_master()
+
+
 def set_master():
     log.info("Labeling this pod as master")
-    cl = kubernetes.client.ApiClient()
-    api = kubernetes.client.CoreV1Api(cl)
-    master_selector = f"juju-app={JUJU_APPLICATION},role=master"
-    masters = [i.metadata.name for i in api.list_namespaced_pod(NAMESPACE, label_selector=master_selector).items]
+    api = k8s_api()
+    masters = list_masters(consistent=True)
+    if masters == [JUJU_POD_NAME]:
+        log.debug("Already labeled as the only master")
+        return
     found = False
-    for master in masters:
-        if master == JUJU_UNIT_NAME:
-            found = True
-        else:
-            api.patch_namespaced_pod(master, NAMESPACE, {"metadata": {"labels": {"role": None}}})
-    if not found:
-        api.patch_namespaced_pod(JUJU_POD_NAME, NAMESPACE, {"metadata": {"labels": {"role": "master"}}})
+    try:
+        for master in masters:
+            if master == JUJU_POD_NAME:
+                found = True
+            else:
+                api.patch_namespaced_pod(master, NAMESPACE, {"metadata": {"labels": {"role": None}}})
+        if not found:
+            api.patch_namespaced_pod(JUJU_POD_NAME, NAMESPACE, {"metadata": {"labels": {"role": "master"}}})
+    finally:
+        invalidate_masters()
 
 
 def set_standby():
     log.info("Labeling this pod as standby")
-    cl = kubernetes.client.ApiClient()
-    api = kubernetes.client.CoreV1Api(cl)
-    api.patch_namespaced_pod(JUJU_POD_NAME, NAMESPACE, {"metadata": {"labels": {"role": "standby"}}})
+    api = k8s_api()
+    try:
+        api.patch_namespaced_pod(JUJU_POD_NAME, NAMESPACE, {"metadata": {"labels": {"role": "standby"}}})
+    finally:
+        invalidate_masters()
 
 
 def set_pod_label():
     key = "pgcharm-pod"
     value = JUJU_POD_NAME
     log.info(f"Labeling this pod as {key}={value} for service discovery")
-    cl = kubernetes.client.ApiClient()
-    api = kubernetes.client.CoreV1Api(cl)
+    api = k8s_api()
     api.patch_namespaced_pod(JUJU_POD_NAME, NAMESPACE, {"metadata": {"labels": {key: value}}})
 
 
-def get_pod_hostname(name) -> str:
-    return f"{JUJU_APPLICATION}-{name}"
-
-
 def init_logging():
     logging.basicConfig(format="%(asctime)-15s %(levelname)8s: %(message)s")
     log.setLevel(logging.DEBUG)
 
 
 def debug_docker_entrypoint():
-    import time
     import traceback
 
     try:
         docker_entrypoint()
     except Exception:
         traceback.print_exc()
-        while True:
-            time.sleep(600)
+        hang_forever()
 
 
 def docker_entrypoint():
     init_logging()
     configure_k8s_api()
 
-    set_pod_label()  # Label pod to match the pod-unique Service selector.
-
     # Repmgr is configured to log to a file, because the history might
     # be needed for disaster recovery. But it is also useful for output
     # to be seen in the pod logs (?). So tail the repmgr log file.
-    p = subprocess.Popen(["tail", "-F", REPMGR_LOG], text=True)
+    # This needs to be a separate process, as it must keep running
+    # after we exec repmgrd.
+    subprocess.Popen(["tail", "-F", REPMGR_LOG], text=True)
 
     # TODO: Schedule log rotations, PostgreSQL and repmgr
 
-    fix_mounts()
-
-    update_pgpass()
+    # update_repmgr_conf needs the directories created by fix_mounts,
+    # but the other steps are independent and can run alongside them.
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        futures = [
+            ex.submit(set_pod_label),  # Label pod to match the pod-unique Service selector.
+            ex.submit(update_pgpass),
+            ex.submit(fix_mounts_and_repmgr_conf),
+        ]
+        for f in futures:
+            f.result()
 
-    update_repmgr_conf()
+    master = is_master()
 
-    db_created = maybe_create_db()
+    db_created = maybe_create_db(standby=not master)
 
     update_postgresql_conf()
 
-    if is_master():
+    if master:
         start_db()
         update_repmgr_db()
         register_repmgr_master()
@@ -536,12 +794,9 @@ def docker_entrypoint():
 
     exec_repmgrd()  # Does not return
 
-    p.terminate()
-
 
 def exec_repmgrd():
-    cmd = AS_PG_CMD + ["repmgrd", "-v", "-f", REPMGR_CONF, "--daemonize=false", "--no-pid-file"]
-    os.execvp(cmd[0], cmd)  # Should not return
+    os.execvpe(REPMGRD_CMD[0], REPMGRD_CMD, PG_ENV)  # Should not return
 
 
 def promote_entrypoint():
@@ -551,7 +806,9 @@ def promote_entrypoint():
     set_master()  # First, lessening chance connections go to an existing master.
     cmd = AS_PG_CMD + ["repmgr", "standby", "promote", "-v", "-f", REPMGR_CONF, "--log-to-file"]
     log.info(f"Running {' '.join(cmd)}")
-    subprocess.check_call(cmd, text=True)
+    # Nothing left to do, so replace this process. repmgrd sees
+    # repmgr's exit status directly.
+    os.execvpe(cmd[0], cmd, PG_ENV)  # Does not return
 
 
 def follow_entrypoint():
@@ -573,11 +830,14 @@ def follow_entrypoint():
             f"--upstream-node-id={node_id}",
         ],
         text=True,
+        env=PG_ENV,
     )
     set_standby()
 
 
 def hang_forever():
+    # Block until a signal arrives, exiting cleanly on SIGTERM.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    log.debug("Idling")
     while True:
-        log.debug("Idling")
-        time.sleep(600)
+        signal.pause()
@@ -16,21 +16,72 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from base64 import b64encode
+import functools
+import hashlib
+import json
 import logging
+import re
+from secrets import token_urlsafe
 from typing import Dict, Iterable, List
 
-from charmhelpers.core import host, hookenv
+from charmhelpers.core import hookenv
 import ops.charm
+import ops.framework
 import ops.main
 import ops.model
-import yaml
 
 from clientrel import ClientRelations
 from leadership import RichLeaderData
 
 log = logging.getLogger(__name__)
 
-REQUIRED_SETTINGS = ["image"]
+REQUIRED_SETTINGS = ("image",)
+
+# Settings rendered into postgresql.conf, and the values PostgreSQL
+# accepts for them. Anything else could break or inject into the file.
+PG_SETTINGS_RE = {
+    "max_wal_size": re.compile(r"\d+\s*(kB|MB|GB|TB)?"),
+    "checkpoint_timeout": re.compile(r"\d+\s*(ms|s|min|h|d)?"),
+}
+
+# This is required, although it should not be exposed. Connections
+# will work, but will be to a random pod. Instead client connections
+# need to go via the $appname-master and $appname-standbys k8s Services.
+POD_PORTS = [
+    {"name": "pgsql", "containerPort": 5432, "protocol": "TCP"},
+]
+
+# Environment variables populated from the pod's own fields.
+POD_FIELD_ENV = {
+    k: {"field": {"path": p, "api-version": "v1"}}
+    for k, p in {
+        "JUJU_NODE_NAME": "spec.nodeName",
+        "JUJU_POD_NAME": "metadata.name",
+        "JUJU_POD_NAMESPACE": "metadata.namespace",
+        "JUJU_POD_IP": "status.podIP",
+        "JUJU_POD_SERVICE_ACCOUNT": "spec.serviceAccountName",
+    }.items()
+}
+
+# Every Service the charm creates exposes just the one PostgreSQL port.
+SERVICE_PORTS = [{"name": "pgsql", "port": 5432, "protocol": "TCP"}]
+
+POD_VOLUMES = [
+    {"name": "charm-secrets", "mountPath": "/charm-secrets", "secret": {"name": "charm-secrets"}},
+    {"name": "var-run-postgresql", "mountPath": "/var/run/postgresql", "emptyDir": {"medium": "Memory"}},
+]
+
+
+class _LazyJSON:
+    """Log argument that is only dumped to JSON if the record is emitted."""
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return json.dumps(self.obj, indent=2, sort_keys=True, default=str)
 
 
 class PostgreSQLCharm(ops.charm.CharmBase):
@@ -39,13 +90,17 @@ class PostgreSQLCharm(ops.charm.CharmBase):
 
         self.client_relations = ClientRelations(self, "client_relations")
         self.leader_data = RichLeaderData(self, "leader_data")
-
-        self.framework.observe(self.on.start, self.on_config_changed)
-        self.framework.observe(self.on.leader_elected, self.on_config_changed)
-        self.framework.observe(self.on.config_changed, self.on_config_changed)
-        self.framework.observe(self.on.upgrade_charm, self.on_config_changed)
-        self.framework.observe(self.on["peer"].relation_joined, self.on_config_changed)
-        self.framework.observe(self.on["peer"].relation_departed, self.on_config_changed)
+        self._admin_password = None
+
+        for event in (
+            self.on.start,
+            self.on.leader_elected,
+            self.on.config_changed,
+            self.on.upgrade_charm,
+            self.on["peer"].relation_joined,
+            self.on["peer"].relation_departed,
+        ):
+            self.framework.observe(event, self.on_config_changed)
 
     def _check_for_config_problems(self) -> str:
         """Return config related problems as a human readable string."""
@@ -53,35 +108,64 @@ class PostgreSQLCharm(ops.charm.CharmBase):
 
         missing = self._missing_charm_settings()
         if missing:
-            problems.append("required setting(s) empty: {}".format(", ".join(sorted(missing))))
+            problems.append("required setting(s) empty: {}".format(", ".join(missing)))
+
+        invalid = self._invalid_charm_settings()
+        if invalid:
+            problems.append("invalid setting(s): {}".format(", ".join(invalid)))
 
-        return "; ".join(filter(None, problems))
+        return "; ".join(problems)
 
     def _missing_charm_settings(self) -> Iterable[str]:
         """Return a list of required configuration settings that are not set."""
-        config = self.model.config
-        missing = [setting for setting in REQUIRED_SETTINGS if not config[setting]]
-        if config["image_username"] and not config["image_password"]:
+        config = dict(self.model.config)
+        missing = [setting for setting in REQUIRED_SETTINGS if not config.get(setting)]
+        if config.get("image_username") and not config.get("image_password"):
             missing.append("image_password")
-        return sorted(missing)
+        return missing
+
+    def _invalid_charm_settings(self) -> Iterable[str]:
+        """Return a list of configuration settings with malformed values."""
+        config = self.model.config
+        # fullmatch, as $ would also accept a trailing newline.
+        return [k for k, r in PG_SETTINGS_RE.items() if r.fullmatch(str(config.get(k, ""))) is None]
 
     def on_config_changed(self, event: ops.charm.ConfigChangedEvent):
         """Check that we're leader, and if so, set up the pod."""
+        problems = self._check_for_config_problems()
+        if problems:
+            log.error(problems)
+            self.model.unit.status = ops.model.BlockedStatus(problems)
+            return
+
         if self.model.unit.is_leader():
 
             goal_state = hookenv.goal_state()
 
-            log.info("Goal state <<EOM\n{}\nEOM".format(yaml.dump(goal_state)))
+            log.info("Goal state <<EOM\n%s\nEOM", _LazyJSON(goal_state))
 
             # Only the leader can set_spec().
             spec = self.make_pod_spec()
             resources = self.make_pod_resources()
 
+            # set_spec() kicks off a rollout of the pods on the Juju side,
+            # so skip it if nothing has changed since it was last set. The
+            # hash is kept in leader data, as the spec may have been set
+            # by a previous leader.
+            spec_hash = hashlib.blake2b(
+                json.dumps({"s": spec, "r": resources}, sort_keys=True, default=str).encode("UTF-8")
+            ).hexdigest()
+            if spec_hash == self.leader_data.get("pod_spec_hash"):
+                log.info("Pod spec unchanged")
+                self.model.unit.status = ops.model.ActiveStatus("Pod configured")
+                return
+
             msg = "Configuring pod"
             log.info(msg)
             self.model.unit.status = ops.model.MaintenanceStatus(msg)
 
             self.model.pod.set_spec(spec, {"kubernetesResources": resources})
+            self.leader_data["pod_spec_hash"] = spec_hash
 
             msg = "Pod configured"
             log.info(msg)
@@ -97,31 +181,19 @@ class PostgreSQLCharm(ops.charm.CharmBase):
         image_details = {
             "imagePath": config["image"],
         }
+        if config.get("image_username"):
+            image_details["username"] = config["image_username"]
+        if config.get("image_password"):
+            image_details["password"] = config["image_password"]
 
-        # This is required, although it should not be exposed.
-        # Connections will work, but will be to a random pod. Instead
-        # client connections need to go via the $appname-master and
-        # $appname-standbys k8s Services.
-        ports = [
-            {"name": "pgsql", "containerPort": 5432, "protocol": "TCP"},
-        ]
-
-        config_fields = {
-            "JUJU_NODE_NAME": "spec.nodeName",
-            "JUJU_POD_NAME": "metadata.name",
-            "JUJU_POD_NAMESPACE": "metadata.namespace",
-            "JUJU_POD_IP": "status.podIP",
-            "JUJU_POD_SERVICE_ACCOUNT": "spec.serviceAccountName",
-        }
-        env_config = {k: {"field": {"path": p, "api-version": "v1"}} for k, p in config_fields.items()}
-
+        env_config = dict(POD_FIELD_ENV)
         env_config["JUJU_EXPECTED_UNITS"] = " ".join(self.expected_units)
         env_config["JUJU_APPLICATION"] = self.app.name
 
-        vol_config = [
-            {"name": "charm-secrets", "mountPath": "/charm-secrets", "secret": {"name": "charm-secrets"}},
-            {"name": "var-run-postgresql", "mountPath": "/var/run/postgresql", "emptyDir": {"medium": "Memory"}},
-        ]
+        # PostgreSQL settings, rendered into postgresql.conf by the pod.
+        env_config["PG_MAX_WAL_SIZE"] = config["max_wal_size"]
+        env_config["PG_CHECKPOINT_TIMEOUT"] = config["checkpoint_timeout"]
+        env_config["PG_WAL_COMPRESSION"] = "on" if config["wal_compression"] else "off"
 
         spec = {
             "version": 3,
@@ -130,9 +202,9 @@ class PostgreSQLCharm(ops.charm.CharmBase):
                     "name": self.app.name,
                     "imageDetails": image_details,
                     "imagePullPolicy": "Always",  # TODO: Necessary? Should this be a Juju default?
-                    "ports": ports,
+                    "ports": POD_PORTS,
                     "envConfig": env_config,
-                    "volumeConfig": vol_config,
+                    "volumeConfig": POD_VOLUMES,
                     # "kubernetes": {"readinessProbe": {"exec": {"command": ["/usr/local/bin/docker-readyness.sh"]}}},
                     "kubernetes": {
                         "readinessProbe": {"tcpSocket": {"port": 5432}, "initialDelaySeconds": 3, "periodSeconds": 3}
@@ -140,13 +212,11 @@ class PostgreSQLCharm(ops.charm.CharmBase):
                 }
             ],
         }
-        log.info(f"Pod spec <<EOM\n{yaml.dump(spec)}\nEOM")
 
-        # After logging, attach our secrets.
-        if config.get("image_username"):
-            image_details["username"] = config["image_username"]
-        if config.get("image_password"):
-            image_details["password"] = config["image_password"]
+        # Log a copy with the registry credentials stripped. Only the
+        # dicts on the path to imageDetails are copied.
+        log_container = dict(spec["containers"][0], imageDetails={"imagePath": config["image"]})
+        log.info("Pod spec <<EOM\n%s\nEOM", _LazyJSON(dict(spec, containers=[log_container])))
 
         return spec
 
@@ -165,7 +235,7 @@ class PostgreSQLCharm(ops.charm.CharmBase):
                     # give you an unstable IP address (the Pod's
                     # internal IP I believe).
                     "clusterIP": "",
-                    "ports": [{"name": "pgsql", "port": 5432, "protocol": "TCP"}],
+                    "ports": SERVICE_PORTS,
                     "selector": {"juju-app": self.app.name, "role": "master"},
                 },
             },
@@ -174,7 +244,7 @@ class PostgreSQLCharm(ops.charm.CharmBase):
                 "spec": {
                     "type": "NodePort",  # NodePort to enable external connections
                     "clusterIP": "",  # A stable IP address selected by k8s.
-                    "ports": [{"name": "pgsql", "port": 5432, "protocol": "TCP"}],
+                    "ports": SERVICE_PORTS,
                     "selector": {"juju-app": self.app.name, "role": "standby"},
                 },
             },
@@ -195,7 +265,7 @@ class PostgreSQLCharm(ops.charm.CharmBase):
                     "spec": {
                         "type": "ClusterIP",
                         "clusterIP": "None",  # Headless, just use pod IP.
-                        "ports": [{"name": "pgsql", "port": 5432, "protocol": "TCP"}],
+                        "ports": SERVICE_PORTS,
                         "publishNotReadyAddresses": True,
                         # The pod adds the pgcharm-pod label to itself.
                         "selector": {"juju-app": self.app.name, "pgcharm-pod": pod},
@@ -209,24 +279,27 @@ class PostgreSQLCharm(ops.charm.CharmBase):
             # externally available only after 'juju expose'?
             "services": services,
         }
-        log.info(f"Pod resources <<EOM\n{yaml.dump(resources)}\nEOM")
+        log.info("Pod resources <<EOM\n%s\nEOM", _LazyJSON(resources))
 
         # Fill secrets dict with secrets.
+        # The password is URL-safe base64 text from token_urlsafe(), so ASCII.
         secrets = {"pgsql-admin-password": self.get_admin_password()}
         for k, v in secrets.items():
-            secrets_data[k] = b64encode(v.encode("UTF-8")).decode("UTF-8")
+            secrets_data[k] = b64encode(v.encode("ascii")).decode("ascii")
 
         return resources
 
     def get_admin_password(self) -> str:
-        try:
-            return self.leader_data["admin_password"]
-        except KeyError:
-            pw = host.pwgen(40)
-            self.leader_data["admin_password"] = pw
-            return pw
-
-    @property
+        if self._admin_password is None:
+            try:
+                self._admin_password = self.leader_data["admin_password"]
+            except KeyError:
+                pw = token_urlsafe(30)  # 40 characters
+                self.leader_data["admin_password"] = pw
+                self._admin_password = pw
+        return self._admin_password
+
+    @functools.cached_property
     def expected_units(self) -> List[str]:
         # Goal state looks like this:
         #
@@ -238,7 +311,13 @@ class PostgreSQLCharm(ops.charm.CharmBase):
         #   postgresql/1:
         #     since: '2020-08-31 11:05:54Z'
         #     status: maintenance
-        return sorted(hookenv.goal_state().get("units", {}).keys(), key=lambda x: int(x.split("/")[-1]))
+        # Goal state is fixed for the life of the hook, so this is only
+        # computed once.
+        return sorted(hookenv.goal_state().get("units", {}), key=_unit_number)
+
+
+def _unit_number(unit_name: str) -> int:
+    return int(unit_name.rsplit("/", 1)[1])
 
 
 if __name__ == "__main__":
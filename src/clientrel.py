@@ -13,16 +13,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from contextlib import closing
+import functools
+import json
 import logging
 import os
 from pathlib import Path
+from secrets import token_urlsafe
 from typing import Iterable
 
-from charmhelpers.core import host
-import kubernetes
-from kubernetes.client.rest import ApiException as K8sApiException
 import ops.framework
-import ops.model
 
 from connstr import ConnectionString
 from leadership import RichLeaderData
@@ -36,9 +36,12 @@ log = logging.getLogger(__name__)
 
 
 class ClientRelations(ops.framework.Object):
+    _stored = ops.framework.StoredState()
+
     def __init__(self, charm, key):
         super().__init__(charm, key)
         self.charm = charm
+        self._stored.set_default(service_ips={})
         self.passwords = RichLeaderData(self, "passwords")
 
         self.unit = self.model.unit
@@ -46,18 +49,24 @@ class ClientRelations(ops.framework.Object):
 
         self.framework.observe(charm.on["db"].relation_changed, self.on_db_relation_changed)
         self.framework.observe(charm.on["db-admin"].relation_changed, self.on_db_admin_relation_changed)
+        # The charm may have changed or recreated the Services.
+        self.framework.observe(charm.on.config_changed, self.forget_service_ips)
+        self.framework.observe(charm.on.upgrade_charm, self.forget_service_ips)
 
     _authed = False
+    _k8s_api = None
 
     def k8s_auth(self):
         if self._authed:
             return
-        # Remove os.environ.update when lp:1892255 is FIX_RELEASED.
-        os.environ.update(
-            dict(e.split("=") for e in Path("/proc/1/environ").read_text().split("\x00") if "KUBERNETES_SERVICE" in e)
-        )
+        # The kubernetes client is slow to import, and most hooks never
+        # need it, so import on first use.
+        import kubernetes
+
+        _load_k8s_env()
         kubernetes.config.load_incluster_config()
-        self._authed = True
+        # Process wide, like the loaded kubernetes configuration.
+        ClientRelations._authed = True
 
     @property
     def master_service_name(self) -> str:
@@ -69,28 +78,55 @@ class ClientRelations(ops.framework.Object):
 
     @property
     def master_service_ip(self) -> str:
-        svc = self.get_k8s_service(self.master_service_name)
-        if svc is None:
-            return None
-        return svc.spec.cluster_ip
+        return self.get_service_ip(self.master_service_name)
 
     @property
     def standbys_service_ip(self) -> str:
-        svc = self.get_k8s_service(self.standbys_service_name)
-        if svc is None:
-            return None
-        return svc.spec.cluster_ip
-
-    def get_k8s_service(self, name):
-        self.k8s_auth()
-        cl = kubernetes.client.ApiClient()
-        api = kubernetes.client.CoreV1Api(cl)
+        return self.get_service_ip(self.standbys_service_name)
+
+    def forget_service_ips(self, event=None):
+        self._stored.service_ips = {}
+
+    def get_service_ip(self, name) -> str:
+        # A Service's clusterIP is fixed for its lifetime, so once found
+        # it is remembered across hooks, until forget_service_ips().
+        ip = self._stored.service_ips.get(name)
+        if ip is None:
+            svc = self.get_k8s_service(name)
+            ip = svc and svc["spec"].get("clusterIP")
+            if not ip:
+                return None
+            self._stored.service_ips[name] = ip
+        return ip
+
+    def get_k8s_service(self, name) -> dict:
+        """Return the named Service as a plain JSON dict, or None if it does not exist."""
+        import kubernetes
+        from kubernetes.client.rest import ApiException as K8sApiException
+        from urllib3.util import Retry
+
+        if self._k8s_api is None:
+            self.k8s_auth()
+            conf = kubernetes.client.Configuration.get_default_copy()
+            # Retry transient API server failures with backoff, rather
+            # than failing the hook.
+            conf.retries = Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(["GET"]),
+            )
+            # Reuse one client, and its connection pool, for all lookups.
+            self._k8s_api = kubernetes.client.CoreV1Api(kubernetes.client.ApiClient(conf))
         try:
-            return api.read_namespaced_service(name, self.model.name)
+            # Skip deserializing into the generated models; we only need
+            # a couple of fields from the raw JSON.
+            resp = self._k8s_api.read_namespaced_service(name, self.model.name, _preload_content=False)
         except K8sApiException as e:
             if e.status == 404:
                 return None
             raise
+        return json.loads(resp.data)
 
     def on_db_admin_relation_changed(self, event):
         self.on_db_relation_changed(event, admin=True)
@@ -113,15 +149,17 @@ class ClientRelations(ops.framework.Object):
         # Inspect requests from the client. First look in Application
         # data for modern clients. Fall back to eventually consistent
         # unit data.
-        for bucket in [event.relation.data[event.app], event.relation.data[event.unit]]:
+        for entity in (event.app, event.unit):
+            bucket = event.relation.data[entity]
             dbname = bucket.get("database", "")
             sroles = bucket.get("roles", "")
-            roles = list(_csplit(sroles))
             sextensions = bucket.get("extensions", "")
-            extensions = list(_csplit(sextensions))
-            if dbname or roles or extensions:
-                log.info(f"Client requested {dbname=} {roles=} {extensions=}")
+            if dbname or sroles or sextensions:
                 break
+        roles = list(_csplit(sroles))
+        extensions = list(_csplit(sextensions))
+        if dbname or roles or extensions:
+            log.info("Client requested dbname=%r roles=%r extensions=%r", dbname, roles, extensions)
 
         # Fall back to a database named after the remote Application.
         # This is problematic for cross-model relations, where the
@@ -132,15 +170,15 @@ class ClientRelations(ops.framework.Object):
 
         is_leader = self.unit.is_leader()
         if is_leader:
-            con = pg.connect(
-                ConnectionString(
-                    host=master_ip, dbname="postgres", user="postgres", password=self.charm.get_admin_password()
-                )
+            admin_con_str = ConnectionString(
+                host=master_ip, dbname="postgres", user="postgres", password=self.charm.get_admin_password()
             )
-            pg.ensure_user(con, username, password, superuser=admin)
-            pg.ensure_db(con, dbname, username)
-            pg.ensure_roles(con, roles)
-            pg.ensure_extensions(con, extensions)
+            # Close the connection when done, even if provisioning fails.
+            with closing(pg.connect(admin_con_str)) as con:
+                pg.ensure_user(con, username, password, superuser=admin)
+                pg.ensure_db(con, dbname, username)
+                pg.ensure_roles(con, roles)
+                pg.ensure_extensions(con, extensions)
 
         # Publish allowed-subnets to the relation, listing the
         # egress-subnets that have been granted access.
@@ -151,17 +189,7 @@ class ClientRelations(ops.framework.Object):
         port = 5432
 
         # Publish connection details to the master.
-        master = ConnectionString(
-            host=master_ip,
-            dbname=dbname,
-            port=port,
-            user=username,
-            password=password,
-            fallback_application_name=event.app.name,
-            sslmode="prefer",
-        )
-        standbys = ConnectionString(
-            host=standbys_ip,
+        conn_kw = dict(
             dbname=dbname,
             port=port,
             user=username,
@@ -169,6 +197,8 @@ class ClientRelations(ops.framework.Object):
             fallback_application_name=event.app.name,
             sslmode="prefer",
         )
+        master = ConnectionString(host=master_ip, **conn_kw)
+        standbys = ConnectionString(host=standbys_ip, **conn_kw)
 
         # Echo back data to clients so they know their requested changes
         # have been made. On Application data for modern clients, and
@@ -176,59 +206,66 @@ class ClientRelations(ops.framework.Object):
         to_publish = [event.relation.data[self.unit]]
         if is_leader:
             to_publish.append(event.relation.data[self.app])
-        for bucket in to_publish:
-            bset(bucket, "database", dbname)
-            bset(bucket, "roles", sroles)
-            bset(bucket, "extensions", sextensions)
-            bset(bucket, "allowed-subnets", allowed_subnets)
-            bset(bucket, "master", str(master))
-            bset(bucket, "standbys", str(standbys))
-
+        payload = {
+            "database": dbname,
+            "roles": sroles,
+            "extensions": sextensions,
+            "allowed-subnets": allowed_subnets,
+            "master": str(master),
+            "standbys": str(standbys),
             # Charm only supports PG 12. If we support other versions,
             # we would need to somehow extract this information from
             # the image or a running pod. Pods could label themselves
             # with the baked in version.
-            bset(bucket, "version", str(PG_MAJOR))
-
+            "version": str(PG_MAJOR),
             # Legacy protocol for antique clients, deprecated.
-            if is_leader:
-                bset(bucket, "host", master_ip)
-                bset(bucket, "state", "master")
-            else:
-                bset(bucket, "host", standbys_ip)
-                bset(bucket, "state", "hot standby")
-            bset(bucket, "port", str(port))
-            bset(bucket, "user", username)
-            bset(bucket, "password", password)
-            bset(bucket, "allowed-units", allowed_units)
+            "host": master_ip if is_leader else standbys_ip,
+            "state": "master" if is_leader else "hot standby",
+            "port": str(port),
+            "user": username,
+            "password": password,
+            "allowed-units": allowed_units,
+        }
+        for bucket in to_publish:
+            bupdate(bucket, payload)
 
     def db_password(self, username):
-        if username not in self.passwords:
+        # A single lookup, as each one is a YAML decode of the leader data.
+        password = self.passwords.get(username)
+        if password is None:
             if not self.unit.is_leader():
                 return None
-            self.passwords[username] = host.pwgen(40)
-        return self.passwords[username]
+            password = token_urlsafe(30)  # 40 characters
+            self.passwords[username] = password
+        return password
 
     def get_allowed_subnets(self, relation) -> str:
         subnets = set()
-        for key, reldata in relation.data.items():
-            if "/" in key.name:
-                subnets.update(set(_csplit(reldata["egress-subnets"])))
+        for unit in relation.units:
+            subnets.update(_csplit(relation.data[unit].get("egress-subnets")))
         return ",".join(sorted(subnets))
 
     def get_allowed_units(self, relation) -> str:
-        return ",".join(sorted(unit.name for unit in relation.data if isinstance(unit, ops.model.Unit)))
+        return ",".join(sorted(unit.name for unit in relation.units))
 
 
 # Workaround for https://github.com/canonical/operator/pull/399/files
-def bset(bucket, key, value):
-    if value or key in bucket:
-        bucket[key] = value
+def bupdate(bucket, data):
+    """Update the bucket from data in one go, skipping empty values for unset keys."""
+    bucket.update({k: v for k, v in data.items() if v or k in bucket})
+
+
+@functools.lru_cache(maxsize=None)
+def _load_k8s_env() -> None:
+    """Copy the KUBERNETES_SERVICE_* variables from pid 1, once per process."""
+    # Remove this when lp:1892255 is FIX_RELEASED.
+    for entry in Path("/proc/1/environ").read_bytes().split(b"\x00"):
+        if entry.startswith(b"KUBERNETES_SERVICE"):
+            k, _, v = entry.partition(b"=")
+            os.environ[k.decode()] = v.decode()
 
 
 def _csplit(s) -> Iterable[str]:
-    if s:
-        for b in s.split(","):
-            b = b.strip()
-            if b:
-                yield b
+    if not s:
+        return ()
+    return filter(None, map(str.strip, s.split(",")))
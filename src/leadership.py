@@ -16,12 +16,17 @@
 # TODO: Most of all of this module should move into the Operator Framework core
 
 import collections.abc
+import json
 import subprocess
 from typing import Any, Iterable, Dict, MutableMapping, Protocol
 
 import ops
 import yaml
 
+# Prefer the libyaml bindings, which are much faster, when available.
+_YAMLLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+_YAMLDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
 
 class _Codec(Protocol):
     def encode(self, value: Any) -> str:
@@ -75,6 +80,14 @@ class _PeerData(ops.framework.Object, collections.abc.MutableMapping, metaclass=
             raise RuntimeError("non-leader attempting to set peer data")
         del self._store[self._prefixed_key(key)]
 
+    def update(self, other=(), **kw) -> None:
+        items = dict(other, **kw)
+        if not all(isinstance(key, str) for key in items):
+            raise TypeError(f"keys must be strings, got {repr(list(items))}")
+        if not self.model.unit.is_leader():
+            raise RuntimeError("non-leader attempting to set peer data")
+        self._store.update({self._prefixed_key(k): self._codec.encode(v) for k, v in items.items()})
+
     def __iter__(self) -> Iterable[str]:
         return iter(self._store)
 
@@ -139,7 +152,7 @@ class RichLeaderData(_PeerData):
 
 class _YAMLCodec(object):
     def encode(self, value: Any) -> str:
-        return yaml.safe_dump(value)
+        return yaml.dump(value, Dumper=_YAMLDumper)
 
     def decode(self, key: str, value: str) -> Any:
         if not value:
@@ -147,7 +160,7 @@ class _YAMLCodec(object):
             # empty string or none, value will contain
             # the YAML representation.
             raise KeyError(key)
-        return yaml.safe_load(value)
+        return yaml.load(value, Loader=_YAMLLoader)
 
 
 class _RawCodec(object):
@@ -187,26 +200,33 @@ class LeadershipSettings(collections.abc.MutableMapping):
         # attribute.
         cls = self.__class__
         if cls.__cls_cache is None:
-            cmd = ["leader-get", "--format=yaml"]
-            cls.__cls_cache = yaml.safe_load(subprocess.check_output(cmd).decode("UTF-8")) or {}
+            cmd = ["leader-get", "--format=json"]
+            cls.__cls_cache = json.loads(subprocess.check_output(cmd).decode("UTF-8")) or {}
         return cls.__cls_cache
 
     def __getitem__(self, key: str) -> str:
         return self._cache.get(key, "")
 
     def __setitem__(self, key: str, value: str):
-        if "=" in key:
-            # Leave other validation to the leader-set tool
-            raise RuntimeError(f"LeadershipSettings keys may not contain '=', got {key}")
-        if value is None:
-            value = ""
-        cmd = ["leader-set", f"{key}={value}"]
+        self.update({key: value})
+
+    def update(self, other=(), **kw) -> None:
+        """Set several keys with a single leader-set invocation."""
+        items = {k: "" if v is None else v for k, v in dict(other, **kw).items()}
+        if not items:
+            return
+        for key in items:
+            if "=" in key:
+                # Leave other validation to the leader-set tool
+                raise RuntimeError(f"LeadershipSettings keys may not contain '=', got {key}")
+        cmd = ["leader-set"] + [f"{k}={v}" for k, v in items.items()]
         subprocess.check_call(cmd)
         if self._cache_loaded:
-            if value == "":
-                del self._cache[key]
-            else:
-                self._cache[key] = value
+            for key, value in items.items():
+                if value == "":
+                    self._cache.pop(key, None)
+                else:
+                    self._cache[key] = value
 
     def __delitem__(self, key: str):
         self[key] = ""
@@ -16,11 +16,11 @@
 import functools
 import logging
 import re
-from typing import Any, Iterable
+from typing import Any, Iterable, Set, Tuple
 
 import psycopg2
 import psycopg2.extensions
-from tenacity import before_log, retry, retry_if_exception_type, stop_after_delay, wait_random_exponential
+from tenacity import before_log, retry_if_exception, stop_after_delay, wait_random_exponential, Retrying
 
 from connstr import ConnectionString
 
@@ -29,49 +29,77 @@ log = logging.getLogger(__name__)
 
 PGConnection = psycopg2.extensions.connection
 
+# An extension name, optionally followed by its schema in parentheses.
+_EXTENSION_RE = re.compile(r"\s*([^(\s]+)\s*(?:\((\w+)\))?")
+
+# ensure_user statements, keyed by (role exists, superuser, replication).
+_ENSURE_USER_SQL = {
+    (exists, su, repl): "{} %s WITH LOGIN {} {} PASSWORD %s".format(
+        "ALTER ROLE" if exists else "CREATE ROLE",
+        "SUPERUSER" if su else "NOSUPERUSER",
+        "REPLICATION" if repl else "NOREPLICATION",
+    )
+    for exists in (False, True)
+    for su in (False, True)
+    for repl in (False, True)
+}
+
+# Characters needing escapes inside a U&"..." identifier.
+_UNICODE_ESCAPE_RE = re.compile(r'[\\"]|[^\x00-\x7f]')
+
+
+def _is_retryable_connect_error(e: BaseException) -> bool:
+    # Retrying a rejected password just delays the inevitable failure.
+    return isinstance(e, psycopg2.OperationalError) and "authentication failed" not in str(e)
+
 
-@retry(
-    retry=retry_if_exception_type(psycopg2.OperationalError),
-    stop=stop_after_delay(300),
-    wait=wait_random_exponential(multiplier=1, max=15),
-    reraise=True,
-    before=before_log(log, logging.DEBUG),
-)
 def connect(conn_str: ConnectionString) -> PGConnection:
-    con = psycopg2.connect(str(conn_str))
+    for attempt in Retrying(
+        retry=retry_if_exception(_is_retryable_connect_error),
+        stop=stop_after_delay(300),
+        wait=wait_random_exponential(multiplier=1, max=15),
+        reraise=True,
+        before=before_log(log, logging.DEBUG),
+    ):
+        with attempt:
+            con = psycopg2.connect(str(conn_str))
+    # Autocommit, as CREATE DATABASE cannot run inside a transaction.
     con.autocommit = True
     return con
 
 
 def ensure_user(con: PGConnection, username: str, password: str, superuser: bool = False, replication: bool = False):
-    if role_exists(con, username):
-        cmd = ["ALTER ROLE"]
-    else:
-        cmd = ["CREATE ROLE"]
-    cmd.append("%s WITH LOGIN")
-    cmd.append("SUPERUSER" if superuser else "NOSUPERUSER")
-    cmd.append("REPLICATION" if replication else "NOREPLICATION")
-    cmd.append("PASSWORD %s")
+    sql = _ENSURE_USER_SQL[(role_exists(con, username), bool(superuser), bool(replication))]
     cur = con.cursor()
-    cur.execute(" ".join(cmd), (pgidentifier(username), password))
+    cur.execute(sql, (pgidentifier(username), password))
 
 
 def ensure_roles(con: PGConnection, roles: Iterable[str]):
-    for role in roles:
-        ensure_role(con, role)
+    wanted_roles = set(roles)
+    if not wanted_roles:
+        return
+    cur = con.cursor()
+    missing_roles = sorted(wanted_roles.difference(_load_existing_roles(cur, wanted_roles)))
+    if missing_roles:
+        # One round trip for all the CREATE ROLE statements.
+        cur.execute(
+            "; ".join(["CREATE ROLE %s INHERIT NOLOGIN"] * len(missing_roles)),
+            [pgidentifier(role) for role in missing_roles],
+        )
 
 
 def ensure_role(con: PGConnection, role: str):
-    cur = con.cursor()
-    cur.execute("SELECT TRUE FROM pg_roles WHERE rolname=%s", (role,))
-    if cur.fetchone() is None:
-        cur.execute("CREATE ROLE %s INHERIT NOLOGIN", (pgidentifier(role),))
+    ensure_roles(con, [role])
 
 
 def role_exists(con: PGConnection, role: str) -> bool:
-    cur = con.cursor()
-    cur.execute("SELECT TRUE FROM pg_roles WHERE rolname=%s", (role,))
-    return cur.fetchone() is not None
+    return role in _load_existing_roles(con.cursor(), [role])
+
+
+def _load_existing_roles(cur, roles: Iterable[str]) -> Set[str]:
+    """Return the subset of roles that exist, in a single query"""
+    cur.execute("SELECT rolname FROM pg_roles WHERE rolname = ANY(%s)", (list(roles),))
+    return set(r[0] for r in cur.fetchall())
 
 
 def grant_user_roles(con: PGConnection, username: str, roles: Iterable[str]):
@@ -91,8 +119,8 @@ def grant_user_roles(con: PGConnection, username: str, roles: Iterable[str]):
 
     if roles_to_grant:
         log.info("Granting {} to {}".format(",".join(roles_to_grant), username))
+        ensure_roles(con, roles_to_grant)
         for role in roles_to_grant:
-            ensure_role(con, role)
             cur.execute("GRANT %s TO %s", (pgidentifier(role), pgidentifier(username)))
 
 
@@ -107,44 +135,54 @@ def ensure_db(con: PGConnection, dbname: str, ownername: str):
 
 
 def grant_database_privileges(con: PGConnection, role: str, dbname: str, privs: Iterable[str]):
+    priv_list = ", ".join(privs)
+    if not priv_list:
+        return
     cur = con.cursor()
-    for priv in privs:
-        cur.execute("GRANT %s ON DATABASE %s TO %s", (AsIs(priv), pgidentifier(dbname), pgidentifier(role)))
+    cur.execute("GRANT %s ON DATABASE %s TO %s", (AsIs(priv_list), pgidentifier(dbname), pgidentifier(role)))
 
 
 def ensure_extensions(con, extensions: Iterable[str]):
     """extensions in format defined in config.yaml"""
 
-    # Convert extensions to (name, schema) tuples
-    extensions = list(extensions)
-    for i in range(0, len(extensions)):
-        m = re.search(r"^\s*([^(\s]+)\s*(?:\((\w+)\))?", extensions[i])
-        if m is None:
-            raise RuntimeError("Invalid extension {}".format(extensions[i]))
-        extensions[i] = (m.group(1), m.group(2) or "public")
+    # Convert extensions to a set of (name, schema) tuples
+    extensions_set = frozenset(map(_parse_extension, extensions))
+    if not extensions_set:
+        return
 
     cur = con.cursor()
     cur.execute("SELECT extname,nspname FROM pg_extension,pg_namespace WHERE pg_namespace.oid = extnamespace")
     installed_extensions = frozenset((x[0], x[1]) for x in cur.fetchall())
-    log.debug(f"ensure_extensions({extensions}), have {installed_extensions}")
-    extensions_set = frozenset(set(extensions))
+    log.debug(f"ensure_extensions({extensions_set}), have {installed_extensions}")
     extensions_to_create = extensions_set.difference(installed_extensions)
+    # Collect the statements and send them to the server in one go.
+    stmts = []
     for ext, schema in extensions_to_create:
         log.info(f"Creating extension {ext}")
         if schema != "public":
-            cur.execute("CREATE SCHEMA IF NOT EXISTS %s", (pgidentifier(schema),))
-            cur.execute("GRANT USAGE ON SCHEMA %s TO PUBLIC", (pgidentifier(schema),))
-        cur.execute("CREATE EXTENSION %s WITH SCHEMA %s", (pgidentifier(ext), pgidentifier(schema)))
+            stmts.append(cur.mogrify("CREATE SCHEMA IF NOT EXISTS %s", (pgidentifier(schema),)))
+            stmts.append(cur.mogrify("GRANT USAGE ON SCHEMA %s TO PUBLIC", (pgidentifier(schema),)))
+        stmts.append(cur.mogrify("CREATE EXTENSION %s WITH SCHEMA %s", (pgidentifier(ext), pgidentifier(schema))))
+    if stmts:
+        cur.execute(b"; ".join(stmts))
+
+
+def _parse_extension(extension: str) -> Tuple[str, str]:
+    m = _EXTENSION_RE.match(extension)
+    if m is None:
+        raise RuntimeError("Invalid extension {}".format(extension))
+    return (m.group(1), m.group(2) or "public")
 
 
-@functools.total_ordering
 class AsIs(psycopg2.extensions.ISQLQuote):
     """An extension of psycopg2.extensions.AsIs
 
-    The comparison operators make it usable in unittests and
-    stable no matter the psycopg2 version.
+    Stable no matter the psycopg2 version. Compare str() of instances
+    in unittests.
     """
 
+    __slots__ = ()  # _wrapped is a slot on ISQLQuote
+
     def getquoted(self):
         return str(self._wrapped).encode("UTF8")
 
@@ -152,12 +190,6 @@ class AsIs(psycopg2.extensions.ISQLQuote):
         if protocol is psycopg2.extensions.ISQLQuote:
             return self
 
-    def __eq__(self, other: Any):
-        return self._wrapped == other
-
-    def __lt__(self, other: Any):
-        return self._wrapped < other
-
     def __str__(self):
         return str(self._wrapped)
 
@@ -165,6 +197,7 @@ class AsIs(psycopg2.extensions.ISQLQuote):
         return "{}({!r})".format(self.__class__.__name__, self._wrapped)
 
 
+@functools.lru_cache(maxsize=1024)
 def quote_identifier(identifier: str):
     r'''Quote an identifier, such as a table or role name.
 
@@ -187,28 +220,41 @@ def quote_identifier(identifier: str):
     "\"""
     >>> print(quote_identifier('\\ aargh \u0441\u043b\u043e\u043d'))
     U&"\\ aargh \0441\043b\043e\043d"
+
+    Characters beyond the Basic Multilingual Plane use the 6 hexdigit
+    escape, and quotes and backslashes are escaped too.
+
+    >>> print(quote_identifier('caf\u00e9'))
+    U&"caf\00e9"
+    >>> print(quote_identifier('smile \U0001f600'))
+    U&"smile \+01f600"
+    >>> print(quote_identifier('\u00e9"\\'))
+    U&"\00e9""\\"
     '''
-    try:
-        identifier.encode("US-ASCII")
-        return '"{}"'.format(identifier.replace('"', '""'))
-    except UnicodeEncodeError:
-        escaped = []
-        for c in identifier:
-            if c == "\\":
-                escaped.append("\\\\")
-            elif c == '"':
-                escaped.append('""')
-            else:
-                c = c.encode("US-ASCII", "backslashreplace").decode("US-ASCII")
-                # Note Python only supports 32 bit unicode, so we use
-                # the 4 hexdigit PostgreSQL syntax (\1234) rather than
-                # the 6 hexdigit format (\+123456).
-                if c.startswith("\\u"):
-                    c = "\\" + c[2:]
-                escaped.append(c)
-        return 'U&"%s"' % "".join(escaped)
+    if identifier.isascii():
+        if '"' not in identifier:
+            return '"' + identifier + '"'
+        return '"' + identifier.replace('"', '""') + '"'
+    else:
+        return 'U&"%s"' % _UNICODE_ESCAPE_RE.sub(_unicode_escape, identifier)
+
 
+def _unicode_escape(m: re.Match) -> str:
+    c = m.group()
+    if c == "\\":
+        return "\\\\"
+    if c == '"':
+        return '""'
+    # PostgreSQL's 4 hexdigit form for the BMP, 6 hexdigit form beyond.
+    if ord(c) <= 0xFFFF:
+        return "\\%04x" % ord(c)
+    return "\\+%06x" % ord(c)
 
+
+@functools.lru_cache(maxsize=1024)
 def pgidentifier(token: str):
-    """Wrap a string for interpolation by psycopg2 as an SQL identifier"""
+    """Wrap a string for interpolation by psycopg2 as an SQL identifier
+
+    The returned AsIs is immutable, so instances are shared between callers.
+    """
     return AsIs(quote_identifier(token))
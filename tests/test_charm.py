@@ -14,6 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
+from unittest.mock import patch
 
 from ops.testing import Harness
 from charm import PostgreSQLCharm
@@ -51,3 +52,58 @@ class TestCharm(unittest.TestCase):
         self.harness.update_config(CONFIG_NO_IMAGE_PASSWORD)
         expected = "required setting(s) empty: image_password"
         self.assertEqual(self.harness.charm._check_for_config_problems(), expected)
+
+    def test_check_for_invalid_pg_settings(self):
+        """Check malformed postgresql.conf settings are reported, not rendered."""
+        self.harness.update_config({"image": "humptydumpty", "max_wal_size": "4GB", "checkpoint_timeout": "15 min"})
+        self.assertEqual(self.harness.charm._check_for_config_problems(), "")
+        for bad in ["", "1GB' ; archive_command='/bin/evil", "1GB\n", "lots"]:
+            with self.subTest(bad=bad):
+                self.harness.update_config({"max_wal_size": bad, "checkpoint_timeout": bad})
+                expected = "invalid setting(s): max_wal_size, checkpoint_timeout"
+                self.assertEqual(self.harness.charm._check_for_config_problems(), expected)
+
+    @patch("charm.PostgreSQLCharm.get_admin_password", return_value="sekrit")
+    @patch("charm.hookenv.goal_state", return_value={"units": {"postgresql/0": {}}})
+    def test_set_spec_only_when_changed(self, *mocks):
+        """Check the pod spec is only set again when it changes."""
+        self.harness.set_leader(True)
+        self.harness.update_config({"image": "humptydumpty"})
+        charm = self.harness.charm
+        # Juju leadership settings, rather than the leader-get and leader-set tools.
+        with patch.object(charm.leader_data, "_store", {}), patch.object(charm.model.pod, "set_spec") as set_spec:
+            charm.on_config_changed(None)
+            charm.on_config_changed(None)
+            set_spec.assert_called_once()
+            self.assertEqual(charm.model.unit.status.message, "Pod configured")
+
+            self.harness.update_config({"max_wal_size": "4GB"})
+            charm.on_config_changed(None)
+            self.assertEqual(set_spec.call_count, 2)
+
+    @patch("charm.PostgreSQLCharm.get_admin_password", return_value="sekrit")
+    @patch("charm.hookenv.goal_state", return_value={"units": {"postgresql/0": {}}})
+    def test_set_spec_after_leadership_regained(self, *mocks):
+        """Check a returning leader sets the spec another leader replaced."""
+        self.harness.set_leader(True)
+        self.harness.update_config({"image": "humptydumpty"})
+        charm = self.harness.charm
+        leader_settings = {}
+        with patch.object(charm.leader_data, "_store", leader_settings), patch.object(
+            charm.model.pod, "set_spec"
+        ) as set_spec:
+            charm.on_config_changed(None)
+            set_spec.assert_called_once()
+
+            # Another unit takes over leadership and sets a different spec.
+            self.harness.set_leader(False)
+            self.harness.update_config({"max_wal_size": "4GB"})
+            charm.on_config_changed(None)
+            set_spec.assert_called_once()
+            leader_settings[charm.leader_data._prefixed_key("pod_spec_hash")] = "another-spec"
+
+            # The config reverts while nobody handles it, and leadership returns.
+            self.harness.update_config({"max_wal_size": "1GB"})
+            self.harness.set_leader(True)
+            charm.on_config_changed(None)
+            self.assertEqual(set_spec.call_count, 2)
@@ -0,0 +1,64 @@
+# This file is part of the PostgreSQL k8s Charm for Juju.
+# Copyright 2020 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from unittest.mock import MagicMock
+
+import pg
+
+
+class TestEnsureRoles(unittest.TestCase):
+    def setUp(self):
+        self.con = MagicMock()
+        self.cur = self.con.cursor.return_value
+
+    def executed(self):
+        """Return the executed (sql, params) calls, with str() of AsIs params."""
+        return [
+            (sql, [str(p) if isinstance(p, pg.AsIs) else p for p in params])
+            for (sql, params), _ in self.cur.execute.call_args_list
+        ]
+
+    def test_no_roles(self):
+        pg.ensure_roles(self.con, [])
+        self.cur.execute.assert_not_called()
+
+    def test_all_roles_exist(self):
+        self.cur.fetchall.return_value = [("a",), ("b",)]
+        pg.ensure_roles(self.con, ["b", "a", "a"])
+        self.cur.execute.assert_called_once()
+        sql, params = self.executed()[0]
+        self.assertEqual(sql, "SELECT rolname FROM pg_roles WHERE rolname = ANY(%s)")
+        self.assertCountEqual(params[0], ["a", "b"])
+
+    def test_new_roles(self):
+        self.cur.fetchall.return_value = [("b",)]
+        pg.ensure_roles(self.con, ["c", "b", "a"])
+        self.assertEqual(len(self.executed()), 2)
+        self.assertEqual(
+            self.executed()[1],
+            ("CREATE ROLE %s INHERIT NOLOGIN; CREATE ROLE %s INHERIT NOLOGIN", ['"a"', '"c"']),
+        )
+
+    def test_role_names_quoted(self):
+        self.cur.fetchall.return_value = []
+        pg.ensure_roles(self.con, ['x"; DROP ROLE postgres; --', "Café"])
+        self.assertEqual(
+            self.executed()[1],
+            (
+                "CREATE ROLE %s INHERIT NOLOGIN; CREATE ROLE %s INHERIT NOLOGIN",
+                ['U&"Caf\\00e9"', '"x""; DROP ROLE postgres; --"'],
+            ),
+        )
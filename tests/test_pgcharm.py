@@ -0,0 +1,99 @@
+# This file is part of the PostgreSQL k8s Charm for Juju.
+# Copyright 2020 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3, as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import grp
+import os
+import pwd
+import stat
+import sys
+import tempfile
+import unittest
+
+# pgcharm runs in the workload pod, and reads its environment on import.
+for k, v in dict(
+    PGDATA="/var/lib/postgresql/data",
+    PG_MAJOR="12",
+    JUJU_POD_NAME="0",
+    JUJU_NODE_NAME="node",
+    JUJU_APPLICATION="postgresql",
+    JUJU_EXPECTED_UNITS="postgresql/0",
+    JUJU_POD_NAMESPACE="model",
+    HOSTNAME="postgresql-0",
+).items():
+    os.environ.setdefault(k, v)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "files"))
+
+import pgcharm  # noqa: E402
+
+
+class TestWriteFile(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = tmpdir.name
+        self.path = os.path.join(self.dir, "f.conf")
+        self.user = pwd.getpwuid(os.getuid()).pw_name
+        self.group = grp.getgrgid(os.getgid()).gr_name
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def mode(self):
+        return stat.S_IMODE(os.stat(self.path).st_mode)
+
+    def test_new_file(self):
+        old_umask = os.umask(0o077)
+        self.addCleanup(os.umask, old_umask)
+        self.assertTrue(pgcharm.write_file(self.path, "a", mode=0o644))
+        self.assertEqual(self.read(), "a")
+        self.assertEqual(self.mode(), 0o644)
+        self.assertEqual(os.listdir(self.dir), ["f.conf"])
+
+    def test_unchanged(self):
+        pgcharm.write_file(self.path, "a", mode=0o600, user=self.user, group=self.group)
+        ino = os.stat(self.path).st_ino
+        self.assertFalse(pgcharm.write_file(self.path, "a", mode=0o600, user=self.user, group=self.group))
+        self.assertEqual(os.stat(self.path).st_ino, ino)
+
+    def test_unchanged_fixes_mode(self):
+        pgcharm.write_file(self.path, "a", mode=0o644)
+        self.assertFalse(pgcharm.write_file(self.path, "a", mode=0o600))
+        self.assertEqual(self.mode(), 0o600)
+
+    @unittest.skipUnless(os.geteuid() == 0, "chown requires root")
+    def test_unchanged_fixes_ownership(self):
+        pgcharm.write_file(self.path, "a")
+        os.chown(self.path, 65534, 65534)
+        self.assertFalse(pgcharm.write_file(self.path, "a", user="root", group="root"))
+        st = os.stat(self.path)
+        self.assertEqual((st.st_uid, st.st_gid), (0, 0))
+
+    def test_changed_is_replaced(self):
+        pgcharm.write_file(self.path, "a")
+        ino = os.stat(self.path).st_ino
+        self.assertTrue(pgcharm.write_file(self.path, "b", mode=0o600))
+        self.assertEqual(self.read(), "b")
+        self.assertEqual(self.mode(), 0o600)
+        self.assertNotEqual(os.stat(self.path).st_ino, ino)
+        self.assertEqual(os.listdir(self.dir), ["f.conf"])
+
+    def test_stale_tmp_file(self):
+        tmp = f"{self.path}.tmp.{os.getpid()}"
+        with open(tmp, "w") as f:
+            f.write("stale")
+        self.assertTrue(pgcharm.write_file(self.path, "a"))
+        self.assertEqual(self.read(), "a")
+        self.assertEqual(os.listdir(self.dir), ["f.conf"])